@@ -2,18 +2,30 @@
 Download 4chan images from external arrchives
 """
 
+import heapq
+import itertools
 import json
+import math
 import shutil
+import sqlite3
+import threading
 import time
-import cloudscraper
+
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from common.lib.helpers import UserInput
 from backend.lib.processor import BasicProcessor
 from backend.lib.proxied_requests import FailedProxiedRequest
 from common.lib.exceptions import ProcessorInterruptedException, FourcatException
 
-class InvalidDownloadedFileException(FourcatException):
-    pass
+# orjson decodes API responses considerably faster, but is optional
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 __author__ = "Sal Hagen"
 __credits__ = ["Sal Hagen"]
@@ -21,6 +33,99 @@ __maintainer__ = "Sal Hagen"
 __email__ = "4cat@oilab.eu"
 
 
+class InvalidDownloadedFileException(FourcatException):
+    pass
+
+
+class ArchiveLookupCache:
+    """
+    Cache of archive API lookups
+
+    Stores the image URL found for an API URL, or the reason none was found, so that lookups done in earlier runs
+    don't have to be requested again. Entries expire after `FOUND_TTL` or `MISSING_TTL` seconds; expired entries
+    with an `ETag` or `Last-Modified` value can be revalidated with a conditional request.
+    """
+    FOUND_TTL = 30 * 86400
+    MISSING_TTL = 7 * 86400
+
+    # Writes are committed in batches of this size rather than one by one
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(str(path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS lookups (url TEXT PRIMARY KEY, image_url TEXT, reason TEXT, "
+                        "timestamp INTEGER, etag TEXT, last_modified TEXT)")
+        self.db.commit()
+        self.pending_writes = 0
+
+    def get(self, url):
+        """
+        Get a cached lookup
+
+        :param str url:  API URL
+        :return tuple:  Whether there was a (non-expired) cache hit, the cached image URL, which may be `None`, and
+        the headers to revalidate an expired entry with, if any
+        """
+        row = self.db.execute("SELECT image_url, timestamp, etag, last_modified FROM lookups WHERE url = ?",
+                              (url,)).fetchone()
+        if not row:
+            return False, None, {}
+
+        image_url, timestamp, etag, last_modified = row
+        ttl = self.FOUND_TTL if image_url else self.MISSING_TTL
+        if timestamp >= time.time() - ttl:
+            return True, image_url, {}
+
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        return False, image_url, headers
+
+    def set(self, url, image_url, reason=None, response=None):
+        """
+        Store a lookup
+
+        :param str url:  API URL
+        :param str|None image_url:  Image URL found, or `None` if the archive has no image for it
+        :param str|None reason:  Why no image URL was found
+        :param response:  Response of the lookup, to take `ETag` and `Last-Modified` headers from
+        """
+        headers = response.headers if response is not None else {}
+        self.db.execute("INSERT OR REPLACE INTO lookups (url, image_url, reason, timestamp, etag, last_modified) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (url, image_url, reason, int(time.time()), headers.get("ETag"), headers.get("Last-Modified")))
+        self.written()
+
+    def refresh(self, url):
+        """
+        Mark a lookup as up to date, after the archive confirmed it has not changed
+
+        :param str url:  API URL
+        """
+        self.db.execute("UPDATE lookups SET timestamp = ? WHERE url = ?", (int(time.time()), url))
+        self.written()
+
+    def written(self):
+        """
+        Count a write, and commit once `COMMIT_INTERVAL` writes are pending
+        """
+        self.pending_writes += 1
+        if self.pending_writes >= self.COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        """
+        Commit any pending writes and close the database
+        """
+        self.db.commit()
+        self.db.close()
+
+
 class FourchanSearchImageDownloader(BasicProcessor):
     """
     Image downloader
@@ -64,6 +169,39 @@ class FourchanSearchImageDownloader(BasicProcessor):
         }
     }
 
+    # 4plebs allows one API request per five seconds; requests are spread over a few threads so their latency overlaps
+    FOURPLEBS_API_INTERVAL = 5
+    FOURPLEBS_API_WORKERS = 4
+
+    # Longest an API retry waits, whatever the archive's Retry-After header asks for
+    MAX_RETRY_DELAY = 60
+
+    # Shared cloudscraper session, see `get_scraper()`
+    scraper = None
+    scraper_lock = threading.Lock()
+
+    # How many API lookups are queued at any time
+    API_QUEUE_SIZE = 32
+
+    # Max API lookups per requested image, to leave room for lookups that give no image
+    API_URLS_PER_IMAGE = 3
+
+    # Videos can't be downloaded from the archives. Extensions are usually stored with a leading dot, as 4chan does,
+    # but not by every source.
+    SKIP_EXTENSIONS = frozenset({".mp4", ".webm", "mp4", "webm"})
+
+    # Lookup results that mean the archive doesn't have an image for a URL, rather than that the request failed
+    CACHEABLE_MISSES = ("Missing media data", "API 404")
+
+    # Bytes to read from the network at a time when downloading images
+    DOWNLOAD_CHUNK_SIZE = 256 * 1024
+    # How often to try to resume a download that was cut off
+    MAX_DOWNLOAD_RESUMES = 3
+
+    # Min. seconds between status updates in loops
+    STATUS_INTERVAL = 0.5
+    last_status_update = 0
+
     UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:146.0) Gecko/20100101 Firefox/146.0"
 
     @classmethod
@@ -123,18 +261,24 @@ class FourchanSearchImageDownloader(BasicProcessor):
         self.staging_area = self.dataset.get_staging_area()
         self.complete = False
         self.filenames = {} # Maps URL -> Filename
+        self.queued_filenames = set()  # Filenames in self.filenames, see `add_image_url()`
 
-        # Get Image URLs from source dataset through the chan archive APIs
+        # Get Image URLs from source dataset through the chan archive APIs. The API URLs are generated while the
+        # source dataset is read, so requests start before the whole dataset has been iterated.
+        self.num_api_urls = 0
         api_urls = self.get_api_urls()
-        if not api_urls:
-            self.dataset.finish_with_error("No archive API urls found in the dataset to get the image URLs.")
-            return
-
-        self.dataset.update_status(f'Collected {len(api_urls)} search urls.')
 
         # Query APIs to get actual image URLs. This often differs with the `tim` field in the source dataset,
         # so this step is necessary to get a full list.
-        self.collect_image_urls(api_urls)
+        self.lookup_cache = ArchiveLookupCache(self.config.PATH_DATA.joinpath("4chan_api_cache.sqlite"))
+        try:
+            self.collect_image_urls(api_urls)
+        finally:
+            self.lookup_cache.close()
+
+        if not self.num_api_urls:
+            self.dataset.finish_with_error("No archive API urls found in the dataset to get the image URLs.")
+            return
 
         if not self.filenames:
             self.dataset.finish_as_empty("No image URLs found after API search.", is_final=True)
@@ -144,44 +288,65 @@ class FourchanSearchImageDownloader(BasicProcessor):
         self.download_images()
 
     def get_api_urls(self):
-        """Iterates the source dataset to build API search URLs."""
+        """
+        Iterates the source dataset to build API search URLs.
+
+        Keeps count of the URLs generated so far in `self.num_api_urls`.
+
+        :return Generator[tuple]:  API URL and the board of the post it looks up, or `None` for MD5 searches
+        """
         self.dataset.update_status("Reading source file")
-        search_urls = set()
 
         # Load config for the selected archive
         archive_config = self.ARCHIVE_CONFIG[self.archive_choice]
         api_base = archive_config["api_base"]
-        supported_boards = archive_config["boards"]
+        supported_boards = frozenset(archive_config["boards"])
+        skip_extensions = self.SKIP_EXTENSIONS
+
+        # Posts and MD5s we already have a URL for; many rows share an image
+        seen_posts = set()
+        seen_md5s = set()
+
+        # Not every lookup gives an image, but there's no need to read the whole dataset for a handful of them
+        max_urls = self.amount * self.API_URLS_PER_IMAGE if self.amount > 0 else None
 
         item_index = 0
         for item in self.source_dataset.iterate_items(self):
+            if max_urls and self.num_api_urls >= max_urls:
+                break
+
             item_index += 1
             if item_index % 50 == 0:
-                self.dataset.update_status(f"Extracting URLs from item {item_index}/{self.source_dataset.num_rows}")
+                self.update_status_throttled(f"Extracting URLs from item {item_index}/{self.source_dataset.num_rows}")
 
-            if not item.get("md5"):
+            if not (md5 := item.get("md5")):
                 continue
-            if item.get("ext") in [".mp4", ".webm"]:
+            if item.get("ext") in skip_extensions:
                 continue
 
             # Determine if we use direct post lookup or MD5 search
             # If the board is supported by the selected archive, use direct post lookup
-            if item["board"] in supported_boards:
-                url = f"{api_base}/_/api/chan/post/?board={item['board']}&num={item['id']}"
+            board = item["board"]
+            if board in supported_boards:
+                post = (board, item["id"])
+                if post in seen_posts:
+                    continue
+                seen_posts.add(post)
+                self.num_api_urls += 1
+                yield f"{api_base}/_/api/chan/post/?board={board}&num={item['id']}", board
             else:
                 # Fallback to searching desuarchive by MD5 for cross-archive hits?
                 # (Preserving original logic: search by MD5 if board not in list)
-                url = f"https://desuarchive.org/_/api/chan/search/?image={item['md5']}"
+                if md5 in seen_md5s:
+                    continue
+                seen_md5s.add(md5)
+                self.num_api_urls += 1
+                yield f"https://desuarchive.org/_/api/chan/search/?image={md5}", None
 
-            search_urls.add(url)
-
-        if len(search_urls) < self.amount:
-            self.amount = len(search_urls)
-        return search_urls
-
-    def extract_url_from_json(self, response_json, search_url):
+    def extract_url_from_json(self, response_json, board):
         """
         Parses the API JSON to find the image URL.
+        `board` is the board of the looked up post, used to build the CDN URL if the API doesn't give one.
         Returns: (image_url, should_retry, retry_reason)
         """
         cdn_pattern = self.ARCHIVE_CONFIG[self.archive_choice]["cdn_pattern"]
@@ -204,135 +369,397 @@ class FourchanSearchImageDownloader(BasicProcessor):
             else:
                 # Construct from filename pattern
                 image_name = data["media"]["media"]
-                # Extract board from search_url parameters
-                try:
-                    board_param = [p for p in search_url.split("?")[1].split("&") if p.startswith("board=")][0]
-                    board = board_param.split("=")[1]
+                if board:
                     return cdn_pattern.format(board=board, filename=image_name), False, None
-                except IndexError:
-                    pass
 
         return None, False, "Missing media data"
 
+    @classmethod
+    def get_scraper(cls):
+        """
+        Get the cloudscraper session for 4plebs
+
+        The session is created once per worker process and then shared, so its setup and connections are reused by
+        later runs of this processor.
+
+        :return:  Cloudscraper session
+        """
+        with cls.scraper_lock:
+            if cls.scraper is None:
+                # Imported here, since it's fairly heavy and only needed when a dataset is actually processed
+                import cloudscraper
+                cls.scraper = cloudscraper.create_scraper(
+                    browser={"browser": "firefox", "platform": "windows", "mobile": False}
+                )
+
+        return cls.scraper
+
+    @staticmethod
+    def get_filename(image_url):
+        """
+        Get the local filename for an image URL
+
+        :param str image_url:  Image URL
+        :return str:  Filename, at most 500 characters long
+        """
+        filename = image_url.split("/")[-1]
+        return filename[-500:]
+
+    @classmethod
+    def get_retry_delay(cls, response, attempt):
+        """
+        Get how long to wait before retrying a request
+
+        Uses the `Retry-After` header of rate limited (429) or unavailable (503) responses if there is one, so we
+        neither wait longer than needed nor retry before the archive lets us. Otherwise, backs off exponentially.
+        Either way, the delay is at most `MAX_RETRY_DELAY` seconds.
+
+        :param response:  Response to the failed request, or `None` if it failed without one
+        :param int attempt:  Number of the retry, starting at 1
+        :return float:  Seconds to wait
+        """
+        if response is not None and getattr(response, "status_code", None) in (429, 503):
+            retry_after = response.headers.get("Retry-After")
+            delay = None
+            if retry_after:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    try:
+                        retry_at = parsedate_to_datetime(retry_after)
+                        delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+                    except (TypeError, ValueError):
+                        pass
+
+            # "nan" and "inf" parse as floats too, but are no use as a delay
+            if delay is not None and math.isfinite(delay):
+                return min(max(delay, 1.0), cls.MAX_RETRY_DELAY)
+
+        return min(2 ** attempt, cls.MAX_RETRY_DELAY)
+
+    def sleep_interruptibly(self, seconds, stop=None):
+        """
+        Sleep, in short steps so the processor can still be interrupted in the meantime
+
+        :param float seconds:  Seconds to sleep
+        :param threading.Event|None stop:  Event that also ends the sleep early when set
+        :return bool:  Whether the full time was slept, i.e. `False` if interrupted or stopped
+        """
+        deadline = time.monotonic() + seconds
+        while not self.interrupted and not (stop and stop.is_set()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            if stop:
+                stop.wait(min(remaining, 0.5))
+            else:
+                time.sleep(min(remaining, 0.5))
+
+        return False
+
+    def wait_for_api_slot(self):
+        """
+        Block until the next request to the 4plebs API may be sent.
+
+        Slots are handed out `FOURPLEBS_API_INTERVAL` seconds apart, regardless of how many threads are waiting.
+
+        :return bool:  Whether the request may still be sent, i.e. `False` if the lookups were stopped meanwhile
+        """
+        with self.api_slot_lock:
+            now = time.monotonic()
+            delay = self.next_api_slot - now
+            self.next_api_slot = max(self.next_api_slot, now) + self.FOURPLEBS_API_INTERVAL
+
+        return self.sleep_interruptibly(delay, self.lookups_done)
+
+    def fetch_fourplebs_image_url(self, scraper, search_url, board, headers=None):
+        """
+        Get the image URL for a 4plebs API URL, retrying on API errors.
+
+        Called from worker threads, so this does not touch the dataset; the results are handled by
+        `collect_image_urls`.
+
+        :param scraper:  Cloudscraper session
+        :param str search_url:  API URL to request
+        :param str|None board:  Board of the post that is looked up
+        :param dict|None headers:  Extra headers, e.g. to make the request conditional
+        :return tuple:  Image URL, or `None` if it could not be found, the reason it could not be found, and the
+        last response
+        """
+        retries = 0
+        retry_reason = None
+        resp = None
+        while not self.interrupted and not self.lookups_done.is_set():
+            # Enough image URLs may have been found while waiting; don't spend rate limit on a lookup no one needs
+            if not self.wait_for_api_slot():
+                break
+
+            should_retry = False
+            retry_reason = None
+            resp = None
+
+            try:
+                resp = scraper.get(search_url, headers=headers, timeout=20)
+                if resp.status_code == 304:
+                    return None, None, resp
+                elif resp.status_code != 200:
+                    retry_reason = f"API {resp.status_code}"
+                else:
+                    img_url, should_retry, retry_reason = self.extract_url_from_json(json_loads(resp.content), board)
+                    if img_url:
+                        return img_url, None, resp
+            except Exception as e:
+                retry_reason = f"Exception: {e}"
+
+            # Handle retry Logic; there's no point in retrying when the archive doesn't have the post
+            if (should_retry or (retry_reason and "API" in retry_reason)) \
+                    and retry_reason not in self.CACHEABLE_MISSES and retries < 3:
+                retries += 1
+                self.log.debug(f"Retrying {search_url} ({retries}/3): {retry_reason}")
+                self.sleep_interruptibly(self.get_retry_delay(resp, retries), self.lookups_done)
+                continue
+
+            break  # Stop retrying if max retries reached or fatal error
+
+        return None, retry_reason, resp
+
+    def record_lookup(self, search_url, img_url, reason, response):
+        """
+        Store the result of an API lookup
+
+        Adds the image URL to the ones to download and caches the lookup, unless it failed in a way that may not
+        happen next time. A 304 response means the cached result of an earlier run is still valid.
+
+        :param str search_url:  API URL
+        :param str|None img_url:  Image URL found
+        :param str|None reason:  Why no image URL was found
+        :param response:  Response of the lookup
+        """
+        if response is not None and response.status_code == 304:
+            img_url = self.revalidating.pop(search_url, None)
+            self.lookup_cache.refresh(search_url)
+        elif img_url or reason in self.CACHEABLE_MISSES:
+            self.revalidating.pop(search_url, None)
+            self.lookup_cache.set(search_url, img_url, reason, response)
+
+        if img_url:
+            self.add_image_url(img_url)
+
+    def add_image_url(self, img_url):
+        """
+        Add an image URL to the ones to download
+
+        The same file can be found through several lookups, e.g. the post itself and an MD5 search, or at slightly
+        different CDN URLs. Since files are stored by filename, a URL with a filename that is already queued is
+        skipped, so it is only downloaded once (and not written to by two downloads at the same time).
+
+        :param str img_url:  Image URL
+        """
+        filename = self.get_filename(img_url)
+        if filename in self.queued_filenames:
+            return
+
+        self.queued_filenames.add(filename)
+        self.filenames[img_url] = filename
+
     def collect_image_urls(self, search_urls):
         """
         Queries the archive APIs to get image URLs from API requests.
         Handles the difference between Cloudscraper (4plebs) and ProxiedRequests (Desu).
+
+        :param search_urls:  Iterable of (API URL, board) tuples, as generated by `get_api_urls`
         """
         self.dataset.update_status("Collecting image URLs from API")
         retry_counts = {}
 
-        # Strategy 1: Cloudscraper (4plebs)
-        if self.archive_choice == "fourplebs":
-            self.dataset.update_status("Using cloudscraper for 4plebs API requests")
-            scraper = cloudscraper.create_scraper(
-                browser={"browser": "firefox", "platform": "windows", "mobile": False}
-            )
+        # Cached image URLs of expired lookups, used if the archive tells us they have not changed
+        self.revalidating = {}
 
-            for search_url in search_urls:
-                if self.interrupted:
-                    self.flush_proxied_requests()
-                    raise ProcessorInterruptedException()
-
-                # Manual retry loop for synchronous scraper
-                while True:
-                    should_retry = False
+        def uncached(urls):
+            # Skip URLs that were looked up in an earlier run, and make expired lookups conditional
+            for search_url, board in urls:
+                if len(self.filenames) >= self.amount > 0:
+                    return
 
-                    try:
-                        resp = scraper.get(search_url, timeout=20)
-                        if resp.status_code != 200:
-                            retry_reason = f"API {resp.status_code}"
-                        else:
-                            img_url, should_retry, retry_reason = self.extract_url_from_json(resp.json(), search_url)
-                            if img_url:
-                                filename = img_url.split("/")[-1]
-                                if len(filename) > 500:
-                                    filename = filename[-500:]
-                                self.filenames[img_url] = filename
-                                break # Success
-                    except Exception as e:
-                        retry_reason = f"Exception: {e}"
-
-                    # Handle retry Logic
-                    if should_retry or (retry_reason and "API" in retry_reason):
-                        count = retry_counts.get(search_url, 0)
-                        if count < 3:
-                            retry_counts[search_url] = count + 1
-                            sleep_time = 2 ** (count + 1)
-                            self.dataset.update_status(
-                                f"Retrying {search_url} ({count + 1}/3): {retry_reason}"
-                            )
-                            time.sleep(sleep_time)
-                            continue
+                cached, img_url, headers = self.lookup_cache.get(search_url)
+                if not cached:
+                    if headers:
+                        self.revalidating[search_url] = img_url
+                    yield search_url, board, headers
+                elif img_url:
+                    self.add_image_url(img_url)
 
-                    break  # Stop retrying if success or max retries reached or fatal error
+        search_urls = uncached(search_urls)
 
-                time.sleep(5)  # Rate limiting 4plebs, pretty harsh!
-                self.dataset.update_status(f"Retrieved {len(self.filenames)}/{self.amount} image URLs")
-                self.dataset.update_progress(len(self.filenames) / self.amount / 2)
-                if len(self.filenames) >= self.amount > 0:
-                    break
+        # Strategy 1: Cloudscraper (4plebs)
+        if self.archive_choice == "fourplebs":
+            self.dataset.update_status("Using cloudscraper for 4plebs API requests")
+            scraper = self.get_scraper()
+
+            # Requests are sent from a few threads at once, so network latency overlaps, but they are still spaced out
+            # to stay within the 4plebs rate limit.
+            self.next_api_slot = 0
+            self.api_slot_lock = threading.Lock()
+            # Set once no more lookups are needed, so waiting worker threads don't send their requests anyway
+            self.lookups_done = threading.Event()
+
+            with ThreadPoolExecutor(max_workers=self.FOURPLEBS_API_WORKERS) as executor:
+                # Only a few lookups are queued at a time, so URLs are taken from the dataset as they are needed
+                pending = {}
+                try:
+                    while not len(self.filenames) >= self.amount > 0:
+                        queue_size = self.API_QUEUE_SIZE - len(pending)
+                        for search_url, board, headers in itertools.islice(search_urls, queue_size):
+                            future = executor.submit(self.fetch_fourplebs_image_url, scraper, search_url, board,
+                                                     headers)
+                            pending[future] = search_url
+
+                        if not pending:
+                            break
+
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        if self.interrupted:
+                            self.flush_proxied_requests()
+                            raise ProcessorInterruptedException()
+
+                        for future in done:
+                            self.record_lookup(pending.pop(future), *future.result())
+
+                        self.update_status_throttled(f"Retrieved {len(self.filenames)}/{self.amount} image URLs",
+                                                     len(self.filenames) / self.amount / 2)
+                finally:
+                    # Don't send requests for URLs we no longer need; lookups that already started stop before their
+                    # request is sent
+                    self.lookups_done.set()
+                    executor.shutdown(wait=True, cancel_futures=True)
 
         # Strategy 2: Proxied Requests (Desuarchive)
+        # These are already sent concurrently by 4CAT's request pool, so responses are handled as soon as they come in
         else:
-            for search_url, response in self.iterate_proxied_requests(
-                search_urls,
-                preserve_order=False,
-                headers={"User-Agent": self.UA},
-                verify=False,
-                timeout=20,
-            ):
-                if self.interrupted:
-                    self.flush_proxied_requests()
-                    raise ProcessorInterruptedException()
-
-                should_retry = False
-
-                # Check Network Errors
-                if isinstance(response, FailedProxiedRequest):
-                    should_retry = False # ProxiedRequest usually exhausts its own internal retries
-                    self.dataset.update_status(f"Network error for {search_url}: {response.context}")
-                elif response.status_code != 200:
-                    retry_reason = f"API {response.status_code}"
-                else:
-                    try:
-                        img_url, should_retry, retry_reason = self.extract_url_from_json(response.json(), search_url)
-                        if img_url:
-                            self.filenames[img_url] = img_url.split("/")[-1]
-                    except ValueError:
-                        self.dataset.update_status(f"JSON parse failed for {search_url}")
-
-                # Handle Retry Logic (Re-queueing)
-                if should_retry:
-                    count = retry_counts.get(search_url, 0)
-                    if count < 3:
-                        retry_counts[search_url] = count + 1
-                        sleep_time = 2 ** (count + 1)
-                        time.sleep(sleep_time)  # Simple sleep before re-queue
-
+            # iterate_proxied_requests takes URLs from the iterable as it goes, so URLs are read from the dataset as
+            # they are needed. Conditional requests need their own headers; these are set aside by the generator and
+            # pushed separately.
+            boards = {}
+            conditional_urls = deque()
+
+            def plain_urls():
+                for search_url, board, headers in search_urls:
+                    boards[search_url] = board
+                    if headers:
+                        conditional_urls.append((search_url, headers))
+                    else:
+                        yield search_url
+
+            def push_conditional_urls():
+                while conditional_urls:
+                    search_url, headers = conditional_urls.popleft()
+                    self.push_proxied_request(
+                        search_url,
+                        position=-1,
+                        headers={"User-Agent": self.UA, **headers},
+                        verify=False,
+                        timeout=20,
+                    )
+
+            # Retries waiting for their backoff to pass, as a heap of (monotonic time, URL)
+            retry_queue = []
+            urls = plain_urls()
+            round_headers = {}
+            while True:
+                for search_url, response in self.iterate_proxied_requests(
+                    urls,
+                    preserve_order=False,
+                    headers={"User-Agent": self.UA, **round_headers},
+                    verify=False,
+                    timeout=20,
+                ):
+                    if self.interrupted:
+                        self.flush_proxied_requests()
+                        raise ProcessorInterruptedException()
+
+                    push_conditional_urls()
+
+                    # Re-queue retries whose backoff has passed
+                    while retry_queue and retry_queue[0][0] <= time.monotonic():
                         self.push_proxied_request(
-                            search_url,
+                            heapq.heappop(retry_queue)[1],
                             position=-1,
                             headers={"User-Agent": self.UA},
                             verify=False,
                             timeout=20,
                         )
-                        continue
 
-                time.sleep(0.5)
-                self.dataset.update_status(f"Retrieved {len(self.filenames)}/{self.amount} image URLs")
-                self.dataset.update_progress(len(self.filenames) / self.amount / 2)
-                if len(self.filenames) >= self.amount > 0:
+                    should_retry = False
+
+                    # Check Network Errors
+                    if isinstance(response, FailedProxiedRequest):
+                        should_retry = False # ProxiedRequest usually exhausts its own internal retries
+                        self.dataset.update_status(f"Network error for {search_url}: {response.context}")
+                    elif response.status_code == 304:
+                        self.record_lookup(search_url, None, None, response)
+                    elif response.status_code != 200:
+                        retry_reason = f"API {response.status_code}"
+                        should_retry = response.status_code in (429, 503)
+                        self.record_lookup(search_url, None, retry_reason, response)
+                    else:
+                        try:
+                            img_url, should_retry, retry_reason = self.extract_url_from_json(
+                                json_loads(response.content), boards[search_url]
+                            )
+                            self.record_lookup(search_url, img_url, retry_reason, response)
+                        except ValueError:
+                            self.dataset.update_status(f"JSON parse failed for {search_url}")
+
+                    # Handle Retry Logic (Re-queueing)
+                    if should_retry:
+                        count = retry_counts.get(search_url, 0)
+                        if count < 3:
+                            retry_counts[search_url] = count + 1
+                            # Scheduled instead of slept on, so other responses keep being handled meanwhile
+                            retry_at = time.monotonic() + self.get_retry_delay(response, count + 1)
+                            heapq.heappush(retry_queue, (retry_at, search_url))
+                            continue
+
+                    self.update_status_throttled(f"Retrieved {len(self.filenames)}/{self.amount} image URLs",
+                                                 len(self.filenames) / self.amount / 2)
+                    if len(self.filenames) >= self.amount > 0:
+                        conditional_urls.clear()
+                        retry_queue.clear()
+                        break
+
+                # All queued requests are done. Conditional requests may still be waiting if the dataset had no more
+                # plain URLs after them, and retries if their backoff hasn't passed yet; these start another round.
+                if conditional_urls:
+                    search_url, round_headers = conditional_urls.popleft()
+                    urls = [search_url]
+                elif retry_queue:
+                    self.sleep_interruptibly(retry_queue[0][0] - time.monotonic())
+                    if self.interrupted:
+                        raise ProcessorInterruptedException()
+                    urls = [heapq.heappop(retry_queue)[1]]
+                    while retry_queue and retry_queue[0][0] <= time.monotonic():
+                        urls.append(heapq.heappop(retry_queue)[1])
+                    round_headers = {}
+                else:
                     break
 
             # Cleanup
             self.flush_proxied_requests()
 
+        self.update_status_throttled(f"Retrieved {len(self.filenames)}/{self.amount} image URLs",
+                                     len(self.filenames) / self.amount / 2, force=True)
+
     def download_images(self):
         """Downloads the files in self.filenames."""
         downloaded_files = set()
         failures = []
-        metadata = {}
+
+        # Files that may exist in the staging area, including partial downloads. Added to by `stream_url`.
+        self.touched_files = set()
+        # URLs for which the download was cut off, also added to by `stream_url`. These are resumed with a range
+        # request instead of being downloaded from the start again.
+        self.incomplete_downloads = set()
+        resume_attempts = {}
 
         # Limit the input list to the max amount to avoid unnecessary queueing
         targets = list(self.filenames.keys())
@@ -341,62 +768,116 @@ class FourchanSearchImageDownloader(BasicProcessor):
 
         self.dataset.update_status(f"Getting {len(targets):,} image(s).")
 
-        for image_url, response in self.iterate_proxied_requests(
-                targets,
-                preserve_order=False,
-                headers={"User-Agent": self.UA},
-                hooks={"response": self.stream_url},
-                verify=False,
-                timeout=20,
-                stream=True,
-        ):
-            if self.interrupted:
-                self.flush_proxied_requests()
-                shutil.rmtree(self.staging_area)
-                raise ProcessorInterruptedException()
-
-            success = False
-            local_filename = self.filenames[image_url]
-            downloaded_path = self.staging_area.joinpath(local_filename)
-
-            if response.status_code == 200:
-                downloaded_files.add(image_url)
-                success = True
-            else:
-                failures.append(image_url)
-                downloaded_path.unlink(missing_ok=True)
-                self.dataset.update_status(f"Error: status {response.status_code} at {image_url}")
-
-            metadata[image_url] = {
-                "filename": local_filename,
-                "url": image_url,
-                "success": success,
-                "from_dataset": self.source_dataset.key
-            }
+        # Metadata entries are written as soon as they are known instead of being kept in memory until the end. The
+        # file is still a single JSON object keyed by URL, as other processors expect.
+        with self.staging_area.joinpath(".metadata.json").open("w", encoding="utf-8") as metadata_file:
+            metadata_file.write("{")
+            metadata_separator = ""
+
+            try:
+                for image_url, response in self.iterate_proxied_requests(
+                        targets,
+                        preserve_order=False,
+                        headers={"User-Agent": self.UA},
+                        hooks={"response": self.stream_url},
+                        verify=False,
+                        timeout=20,
+                        stream=True,
+                ):
+                    if self.interrupted:
+                        break
+
+                    success = False
+                    local_filename = self.filenames[image_url]
+                    downloaded_path = self.staging_area.joinpath(local_filename)
+                    failed_request = isinstance(response, FailedProxiedRequest)
+
+                    # Resume cut off downloads from where they stopped
+                    if (failed_request or image_url in self.incomplete_downloads) \
+                            and resume_attempts.get(image_url, 0) < self.MAX_DOWNLOAD_RESUMES:
+                        self.incomplete_downloads.discard(image_url)
+                        resume_attempts[image_url] = resume_attempts.get(image_url, 0) + 1
+
+                        headers = {"User-Agent": self.UA}
+                        partial_size = downloaded_path.stat().st_size if downloaded_path.exists() else 0
+                        if partial_size:
+                            headers["Range"] = f"bytes={partial_size}-"
 
-            self.dataset.update_status(f"Downloaded {len(downloaded_files):,} file(s)")
-            self.dataset.update_progress(0.5 + (len(downloaded_files) / len(targets) / 2))
+                        self.push_proxied_request(
+                            image_url,
+                            position=-1,
+                            headers=headers,
+                            hooks={"response": self.stream_url},
+                            verify=False,
+                            timeout=20,
+                            stream=True,
+                        )
+                        continue
 
-            if self.amount > 0 and len(downloaded_files) >= self.amount:
-                self.complete = True
-                break
+                    if not failed_request and image_url not in self.incomplete_downloads \
+                            and response.status_code in (200, 206):
+                        downloaded_files.add(image_url)
+                        success = True
+                    else:
+                        failures.append(image_url)
+                        downloaded_path.unlink(missing_ok=True)
+                        error = response.context if failed_request else f"status {response.status_code}"
+                        self.dataset.update_status(f"Error: {error} at {image_url}")
+
+                    metadata_file.write(metadata_separator + json.dumps(image_url) + ": " + json.dumps({
+                        "filename": local_filename,
+                        "url": image_url,
+                        "success": success,
+                        "from_dataset": self.source_dataset.key
+                    }))
+                    metadata_file.flush()
+                    metadata_separator = ", "
+
+                    self.update_status_throttled(f"Downloaded {len(downloaded_files):,} file(s)",
+                                                 0.5 + (len(downloaded_files) / len(targets) / 2))
+
+                    if self.amount > 0 and len(downloaded_files) >= self.amount:
+                        self.complete = True
+                        break
+            finally:
+                # Also when the loop ends with an error, so the file is still valid JSON
+                metadata_file.write("}")
+
+        if self.interrupted:
+            self.flush_proxied_requests()
+            shutil.rmtree(self.staging_area)
+            raise ProcessorInterruptedException()
 
         # Finalize
-        with self.staging_area.joinpath(".metadata.json").open("w", encoding="utf-8") as outfile:
-            json.dump(metadata, outfile)
+        self.update_status_throttled(f"Downloaded {len(downloaded_files):,} file(s)", force=True)
 
         self.flush_proxied_requests()
 
-        # Cleanup unused files
-        for url, filename in self.filenames.items():
-            fpath = self.staging_area.joinpath(filename)
-            if fpath.exists() and url not in downloaded_files:
-                fpath.unlink()
+        # Cleanup unused files; only files stream_url wrote to can exist
+        for filename in self.touched_files - {self.filenames[url] for url in downloaded_files}:
+            self.staging_area.joinpath(filename).unlink(missing_ok=True)
 
         self.dataset.update_progress(1.0)
-        self.write_archive_and_finish(
-            self.staging_area, len([x for x in metadata.values() if x.get("success")])
-        )
+        self.write_archive_and_finish(self.staging_area, len(downloaded_files))
+
+    def update_status_throttled(self, status, progress=None, force=False):
+        """
+        Update the dataset status and progress, at most once per `STATUS_INTERVAL` seconds.
+
+        Every update is a database write, which adds up when done for every response.
+
+        :param str status:  Status message
+        :param float|None progress:  Progress, if it should be updated too
+        :param bool force:  Update regardless of when the last update was, e.g. at the end of a loop
+        """
+        now = time.monotonic()
+        if not force and now - self.last_status_update < self.STATUS_INTERVAL:
+            return
+
+        self.last_status_update = now
+        self.dataset.update_status(status)
+        if progress is not None:
+            self.dataset.update_progress(progress)
 
     def stream_url(self, response, fourcat_original_url=None, *args, **kwargs):
         """Helper to stream response content to disk."""
@@ -409,15 +890,34 @@ class FourchanSearchImageDownloader(BasicProcessor):
             raise KeyError(f"Missing filename for: {original_url}")
 
         destination = self.staging_area.joinpath(self.filenames[original_url])
-
-        while chunk := response.raw.read(1024, decode_content=True):
-            if not response.ok or self.interrupted or self.complete:
-                response._content_consumed = True
-                response.raw.close()
-                return
-
-            with destination.open("ab") as outfile:
-                outfile.write(chunk)
+        self.touched_files.add(destination.name)
+
+        # A 206 response is the remainder of a download that was cut off earlier
+        mode = "ab" if response.status_code == 206 else "wb"
+        # The length can only be checked if it's the length of what we write
+        expected_size = response.headers.get("Content-Length") if not response.headers.get("Content-Encoding") \
+            else None
+        response.raw.decode_content = True
+        written = 0
+
+        try:
+            with destination.open(mode) as outfile:
+                while chunk := response.raw.read(self.DOWNLOAD_CHUNK_SIZE):
+                    if not response.ok or self.interrupted or self.complete:
+                        break
+
+                    outfile.write(chunk)
+                    written += len(chunk)
+                else:
+                    if response.ok and expected_size and expected_size.isdigit() and written < int(expected_size):
+                        self.incomplete_downloads.add(original_url)
+        except Exception:
+            # E.g. the connection dropped while reading from the response
+            self.incomplete_downloads.add(original_url)
+            raise
+
+        response._content_consumed = True
+        response.raw.close()
 
     @staticmethod
     def map_metadata(url, data):
@@ -6,10 +6,13 @@ See https://github.com/digitalmethodsinitiative/4cat-scrapers
 """
 
 import requests
+import functools
+import html
 import json
 import time
-import pandas as pd
+from collections import deque
 from requests import JSONDecodeError
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, Timeout, RequestException, HTTPError
 from backend.lib.search import Search
 from common.lib.helpers import UserInput, strip_tags
@@ -21,11 +24,70 @@ from common.lib.exceptions import (
 )
 from common.lib.item_mapping import MappedItem
 
+# orjson decodes large search result pages considerably faster, but is optional
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 __author__ = "Sal Hagen"
 __credits__ = ["Sal Hagen"]
 __maintainer__ = "Sal Hagen"
 __email__ = "4cat@oilab.eu"
 
+# Titles and comments are often repeated across posts (e.g. copypasta), so stripping them is cached
+_strip_tags_lru = functools.lru_cache(maxsize=4096)(strip_tags)
+
+
+def strip_tags_cached(text):
+    """
+    Strip HTML tags, using a cache for strings that are not too long
+
+    :param str text:  Text to strip tags from
+    :return str:  Text without HTML tags
+    """
+    # Don't keep very long strings around in the cache
+    if not isinstance(text, str) or len(text) > 8192:
+        return strip_tags(text)
+    return _strip_tags_lru(text)
+
+
+# Fields copied as-is from 4chan / 8kun items in `SearchWebjutter.map_item()`. "op" is mapped separately there.
+# "now" is left out too; it is mapped to "etd_timestamp" there.
+# todo: make this dynamic, but there's a lot of differences between schemas
+KNOWN_CHAN_FIELDS = (
+    "deleted",
+    "timestamp_deleted",
+    "replies_to",
+    "capcode",
+    "trip",
+    "filename",
+    "tim",
+    "ext",
+    "md5",
+    "w",
+    "h",
+    "tw",
+    "th",
+    "fsize",
+    "country",
+    "country_name",
+    "board_flag",
+    "flag_name",
+    "replies",
+    "images",
+    "semantic_url",
+    "sticky",
+    "closed",
+    "archived_on",
+    "scraped_on",
+    "modified_on",
+    "unique_ips",
+    "bumplimit",
+    "imagelimit",
+    "missing_fields"
+)
+
 
 class SearchWebjutter(Search):
     """
@@ -43,8 +105,15 @@ class SearchWebjutter(Search):
     max_workers = 1
     # For API and connection retries.
     max_retries = 3
+    # Minimum seconds between the start of two page requests
+    page_interval = 0.5
+    # Items requested per page; fewer, larger pages mean fewer round trips for big result sets
+    page_size = 1000
 
+    # Parsed webjutter_datasources.json and rendered metadata tables per datasource, reset when the file changes
     datasources = {}
+    datasources_stat = None
+    metadata_tables = {}
 
     config = {
         # Tumblr API keys to use for data capturing
@@ -97,7 +166,9 @@ class SearchWebjutter(Search):
                 }
             }
 
-        elif not datasources_file.exists():
+        try:
+            stat = datasources_file.stat()
+        except FileNotFoundError:
             return {
                 "error": {
                     "type": UserInput.OPTION_INFO,
@@ -106,64 +177,63 @@ class SearchWebjutter(Search):
                 }
             }
 
-        # We have a datasource json from Webjutter to work with, use this for input fields
-        try:
-            cls.datasources = json.load(open(datasources_file, "r"))
-        except json.JSONDecodeError:
-            return {
-                "error": {
-                    "type": UserInput.OPTION_INFO,
-                    "help": "<code>Webjutter is configured and reachable, but the available datasources couldn't be "
-                            "read.</code>",
+        # We have a datasource json from Webjutter to work with, use this for input fields. It is only parsed again,
+        # and the metadata tables rendered again, when the file has changed.
+        # The size is compared as well, since a rewrite can land within the mtime resolution of the filesystem.
+        datasources_stat = (stat.st_mtime_ns, stat.st_size)
+        if cls.datasources_stat != datasources_stat:
+            try:
+                with datasources_file.open("rb") as infile:
+                    cls.datasources = json_loads(infile.read())
+            except json.JSONDecodeError:
+                return {
+                    "error": {
+                        "type": UserInput.OPTION_INFO,
+                        "help": "<code>Webjutter is configured and reachable, but the available datasources couldn't "
+                                "be read.</code>",
+                    }
                 }
-            }
 
-        def create_metadata_table(data, header=""):
-            """Create combined metadata table with records info and metadata"""
+            cls.metadata_tables = {}
+            cls.datasources_stat = datasources_stat
 
-            # Add total records to metadata table
-            table_rows = []
+        def metadata_table(ds_id, data, header=""):
+            if (ds_id, header) not in cls.metadata_tables:
+                cls.metadata_tables[(ds_id, header)] = cls.create_metadata_table(data, header)
+            return cls.metadata_tables[(ds_id, header)]
 
-            # Flatten nested metadata structure
-            def flatten_metadata(data_dict, prefix=""):
-                if not isinstance(data_dict, dict):
-                    return
-                for key, value in data_dict.items():
-                    if isinstance(value, dict):
-                        # If it's a nested dict, recurse with updated prefix
-                        if prefix:
-                            new_prefix = f"{prefix} {key}"
-                        else:
-                            new_prefix = key
-                        flatten_metadata(value, new_prefix)
-                    else:
-                        label = f"{prefix} {key}" if prefix else key
-                        table_rows.append([label, value])
-
-            # Only flatten if data exists
-            if data:
-                flatten_metadata(data)
-
-            if not table_rows:
-                return "No data available"
-
-            combined_df = pd.DataFrame(table_rows)
-            # Format numeric columns
-            for col in combined_df.columns:
-                if combined_df[col].dtype in ['int64', 'float64']:
-                    combined_df[col] = combined_df[col].apply(lambda x: f"{x:,}")
-
-            html_table = combined_df.to_html(header=False, index=False)
-            if header:
-                header_row = f'<tr><th colspan="2" style="text-align: center; font-weight: bold;">{header}</th></tr>'
-                html_table = html_table.replace("<tbody>", f"<tbody>{header_row}")
-            return html_table
-
-        # Get option data from api/overview json file
-        datasource_labels = {
-            ds_id: ds_values.get("name", ds_id)
-            for ds_id, ds_values in cls.datasources["collections"].items()
-        }
+        # Get option data from api/overview json file, with dynamic info fields for each datasource. These are
+        # collected in one pass; only the fields of the selected datasource are shown.
+        datasource_labels = {}
+        datasource_info = {}
+        datasource_query_fields = {}
+        for ds_id, ds_data in cls.datasources["collections"].items():
+            datasource_labels[ds_id] = ds_data.get("name", ds_id)
+            requires = f"webjutter_datasource=={ds_id}"
+
+            # Description
+            if ds_data.get("description"):
+                datasource_info[f"{ds_id}_description"] = {
+                    "type": UserInput.OPTION_INFO,
+                    "help": ds_data.get("description"),
+                    "requires": requires,
+                }
+
+            # For metadata field:
+            if ds_data.get("metadata"):
+                datasource_info[f"{ds_id}_metadata"] = {
+                    "type": UserInput.OPTION_INFO,
+                    "help": metadata_table(ds_id, ds_data.get("metadata"), header="Metadata"),
+                    "requires": requires,
+                }
+
+            # For query fields:
+            if ds_data.get("search_fields"):
+                datasource_query_fields[f"{ds_id}_query_fields"] = {
+                    "type": UserInput.OPTION_INFO,
+                    "help": metadata_table(ds_id, ds_data.get("search_fields"), header="Search fields"),
+                    "requires": requires,
+                }
 
         return {
             "intro": {
@@ -176,28 +246,7 @@ class SearchWebjutter(Search):
                 "options": {**datasource_labels},
             },
             # Dynamic info fields for each datasource
-            # Description
-            **{
-                f"{ds_id}_description": {
-                    "type": UserInput.OPTION_INFO,
-                    "help": ds_data.get("description"),
-                    "requires": f"webjutter_datasource=={ds_id}",
-                }
-                for ds_id, ds_data in cls.datasources["collections"].items()
-                if ds_data.get("description")
-            },
-            # For metadata field:
-            **{
-                f"{ds_id}_metadata": {
-                    "type": UserInput.OPTION_INFO,
-                    "help": create_metadata_table(
-                        ds_data.get("metadata"), header="Metadata"
-                    ),
-                    "requires": f"webjutter_datasource=={ds_id}",
-                }
-                for ds_id, ds_data in cls.datasources["collections"].items()
-                if ds_data.get("metadata")
-            },
+            **datasource_info,
             # Query field
             "query_header": {
                 "type": UserInput.OPTION_INFO,
@@ -217,17 +266,7 @@ class SearchWebjutter(Search):
                 "requires": "webjutter_datasource==fourchan",
             },
             # For query fields:
-            **{
-                f"{ds_id}_query_fields": {
-                    "type": UserInput.OPTION_INFO,
-                    "help": create_metadata_table(
-                        ds_data.get("search_fields"), header="Search fields"
-                    ),
-                    "requires": f"webjutter_datasource=={ds_id}",
-                }
-                for ds_id, ds_data in cls.datasources["collections"].items()
-                if ds_data.get("search_fields")
-            },
+            **datasource_query_fields,
             "board": {
                 "type": UserInput.OPTION_CHOICE,
                 "help": "Board",
@@ -243,9 +282,58 @@ class SearchWebjutter(Search):
             },
         }
 
+    @staticmethod
+    def create_metadata_table(data, header=""):
+        """
+        Create combined metadata table with records info and metadata
+
+        :param dict data:  (Nested) metadata; nested keys are joined into one label
+        :param str header:  Optional header shown above the table
+        :return str:  HTML table
+        """
+
+        # Add total records to metadata table
+        table_rows = []
+
+        # Flatten nested metadata structure, depth-first and in key order. An explicit stack of (prefix, items)
+        # iterators so nesting depth doesn't add recursion.
+        if isinstance(data, dict):
+            stack = deque([("", iter(data.items()))])
+            while stack:
+                prefix, items = stack[-1]
+                for key, value in items:
+                    label = f"{prefix} {key}" if prefix else key
+                    if isinstance(value, dict):
+                        # Nested dict: continue with its items, then resume this level
+                        stack.append((label, iter(value.items())))
+                        break
+                    table_rows.append((label, value))
+                else:
+                    stack.pop()
+
+        if not table_rows:
+            return "No data available"
+
+        def format_cell(value):
+            # Format numbers with thousands separators
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return f"{value:,}"
+            return html.escape(str(value))
+
+        html_table = '<table border="1" class="dataframe"><tbody>'
+        if header:
+            html_table += f'<tr><th colspan="2" style="text-align: center; font-weight: bold;">{header}</th></tr>'
+        html_table += "".join(
+            f"<tr><td>{format_cell(label)}</td><td>{format_cell(value)}</td></tr>" for label, value in table_rows
+        )
+        return html_table + "</tbody></table>"
+
     def get_items(self, query):
         """
         Fetches data from Webjutter via its ES and Mongo-enabled API.
+
+        Items are yielded page by page as they come in, so that large result sets don't have to be kept in memory
+        before being written to the dataset file.
         """
 
         # ready our parameters
@@ -261,63 +349,82 @@ class SearchWebjutter(Search):
         # Board
         board = parameters.get("board")
         if not board:
-            self.dataset.update_status("No board selected")
-            self.dataset.finish(-1)
+            # Search finishes the dataset once this generator is exhausted, so only set a final status here
+            self.dataset.update_status("No board selected", is_final=True)
             return
 
-        search_query = f"board:{board} AND {search_query}"
+        # Group the user query, so that e.g. an OR in it doesn't escape the board filter
+        search_query = f"board:{board} AND ({search_query})" if search_query else f"board:{board}"
 
-        results = []
+        num_items = 0
         total_records = 0
         retries = 0
         has_more = True
+        last_request = 0
         search_after = None  # For ElasticSearch pagination. Used instead of tokens because of large datasets.
 
         self.dataset.update_status(f"Connecting to Webjutter")
 
-        while has_more and retries <= self.max_retries:
-            if self.interrupted:
-                raise ProcessorInterruptedException(
-                    f"Interrupted while fetching items from {datasource} via Webjutter"
-                )
+        # Reuse one connection for all pages instead of a new handshake per request
+        session = self.get_session(user, password)
+
+        try:
+            while has_more and retries <= self.max_retries:
+                if self.interrupted:
+                    raise ProcessorInterruptedException(
+                        f"Interrupted while fetching items from {datasource} via Webjutter"
+                    )
 
-            # Build URL with parameters
-            params = {"q": search_query}
-            if search_after:
-                params["search_after"] = search_after
+                # Pace page requests, counting the time the previous request took
+                wait = self.page_interval - (time.monotonic() - last_request)
+                if wait > 0:
+                    time.sleep(wait)
+                last_request = time.monotonic()
+
+                # Build URL with parameters
+                params = {"q": search_query, "size": self.page_size}
+                if search_after:
+                    params["search_after"] = search_after
+
+                # Send the request
+                try:
+                    request_results = self.webjutter_search_request(
+                        params, datasource, url, user, password, session=session
+                    )
+                except (ConnectionError, Timeout, RequestException, HTTPError, JSONDecodeError) as e:
+                    # Pages that were already yielded have been written; keep this status when Search finishes
+                    self.dataset.update_status(f"Error reaching Webjutter: {e}", is_final=True)
+                    return
 
-            # Send the request
-            try:
-                request_results = self.webjutter_search_request(params, datasource, url, user, password)
-            except (ConnectionError, Timeout, RequestException, HTTPError, JSONDecodeError) as e:
-                self.dataset.update_status("Error reaching webjutter", str(e))
-                self.dataset.finish(-1)
-                return
-
-            items = request_results["results"]
-            if not items:
-                break
+                items = request_results["results"]
+                if not items:
+                    break
 
-            results.extend(items)
-            total_records = request_results.get("total", total_records)
+                num_items += len(items)
+                total_records = request_results.get("total", total_records)
 
-            # Check for search_after pagination
-            search_after = request_results.get("search_after")
-            if search_after:
-                self.dataset.update_status(
-                    f"Retrieved {len(results):,}/{total_records:,} items"
-                )
-                if total_records > 0:
-                    self.dataset.update_progress(len(results) / total_records)
-                has_more = True
-                time.sleep(0.5)
-            else:
-                has_more = False
+                # Check for search_after pagination
+                search_after = request_results.get("search_after")
+                if search_after:
+                    self.dataset.update_status(
+                        f"Retrieved {num_items:,}/{total_records:,} items"
+                    )
+                    if total_records > 0:
+                        self.dataset.update_progress(num_items / total_records)
+                    has_more = True
+                else:
+                    has_more = False
+
+                retries = 0
+
+                # Drop the page before requesting the next one
+                yield from items
+                del items, request_results
 
-            retries = 0
+        finally:
+            session.close()
 
         self.job.finish()
-        return results
 
     @staticmethod
     def map_item(item):
@@ -329,62 +436,47 @@ class SearchWebjutter(Search):
         """
         # Ensure we have an 'id', 'author', and 'body' column, required for 4CAT
         # 4chan / 8kun
-        if item.get("board") and "no" in item:
-            # todo: make this dynamic, but there's a lot of differences between schemas
-            KNOWN_CHAN_FIELDS = (
-                "now",
-                "deleted",
-                "timestamp_deleted",
-                "replies_to",
-                "capcode",
-                "trip",
-                "filename",
-                "tim",
-                "ext",
-                "md5",
-                "w",
-                "h",
-                "tw",
-                "th",
-                "fsize",
-                "country",
-                "country_name",
-                "board_flag",
-                "flag_name"
-                "op",
-                "replies",
-                "images",
-                "semantic_url",
-                "sticky",
-                "closed",
-                "archived_on",
-                "scraped_on",
-                "modified_on",
-                "unique_ips",
-                "bumplimit",
-                "imagelimit",
-                "missing_fields"
-            )
-
-            item = {
-                "board": item.pop("board", ""),
-                "thread": item.pop("thread", "")
-                if not item.get("resto")
-                else item.pop("resto"),
-                "op": item.pop("op", ""),
-                "id": str(item.pop("no", "")),
-                "unix_timestamp": item.pop("time", ""),
-                "etd_timestamp": item.pop("now", ""),
-                "author": item.pop("name", ""),
-                "post_id": item.pop("id", ""),
-                "title": strip_tags(item.pop("sub", "")),
-                "body": item.get("com", ""),
-                "body_no_html": strip_tags(item.pop("com", "")),
-                **{field: item.pop(field, "") for field in KNOWN_CHAN_FIELDS},
+        if "no" in item and item.get("board"):
+            # Read-only; the original item is replaced by the mapped one anyway
+            get = item.get
+            mapped_item = {
+                "board": get("board", ""),
+                "thread": get("thread", "") if not get("resto") else get("resto"),
+                "op": get("op", ""),
+                "id": str(get("no", "")),
+                "unix_timestamp": get("time", ""),
+                "etd_timestamp": get("now", ""),
+                "author": get("name", ""),
+                "post_id": get("id", ""),
+                "title": strip_tags_cached(get("sub", "")),
+                "body": get("com", ""),
+                "body_no_html": strip_tags_cached(get("com", "")),
             }
+            for field in KNOWN_CHAN_FIELDS:
+                mapped_item[field] = get(field, "")
+            item = mapped_item
 
         return MappedItem(item)
 
+    @staticmethod
+    def get_session(user: str, password: str) -> requests.Session:
+        """
+        Create a session for Webjutter requests
+
+        Connections are pooled, so paginated requests keep using the same
+        connection to the Webjutter server.
+
+        :param str user:  Webjutter username
+        :param str password:  Webjutter password
+        :return requests.Session:  Session with authentication set
+        """
+        session = requests.Session()
+        session.auth = (user, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
     @staticmethod
     def webjutter_search_request(
         params: dict,
@@ -394,8 +486,14 @@ class SearchWebjutter(Search):
         password: str,
         max_retries=3,
         timeout=20,
+        session=None,
     ) -> dict:
-        """Make a request to the search endpoint of Webjutter"""
+        """
+        Make a request to the search endpoint of Webjutter
+
+        If a `session` is given, it is used to send the request so that its
+        connection can be reused for subsequent requests.
+        """
 
         if not params:
             raise QueryParametersException("No search query provided.")
@@ -411,18 +509,18 @@ class SearchWebjutter(Search):
         response = None
         url = f"{url.strip()}/api/{collection.strip()}/search/"
         retries = 0
-        max_retries = 3 if max_retries < 1 else max_retries
+        max_retries = 3 if max_retries < 0 else max_retries
 
         while retries <= max_retries:
             try:
-                response = requests.post(
+                response = (session or requests).post(
                     url, params=params, auth=(user, password), timeout=timeout
                 )
 
                 # Check for error status codes before calling raise_for_status()
                 if response.status_code >= 400:
                     try:
-                        error_data = response.json()
+                        error_data = json_loads(response.content)
                         # This catches the "message" field sent by validate_elasticsearch_query in views_api.py
                         if isinstance(error_data, dict) and "message" in error_data:
                             raise QueryParametersException(error_data["message"])
@@ -447,8 +545,12 @@ class SearchWebjutter(Search):
                 time.sleep(2)
 
             except HTTPError as e:
-                if response is not None and response.status_code == 429:
-                    time.sleep(min(2**retries, 60))
+                # Only wait if there is a retry left to wait for; otherwise report the rate limit right away
+                if response is not None and response.status_code == 429 and retries < max_retries:
+                    # Wait as long as the server asks, if it says so
+                    retry_after = response.headers.get("Retry-After", "").strip()
+                    delay = int(retry_after) if retry_after.isdigit() else 2**retries
+                    time.sleep(min(delay, 60))
                     retries += 1
                     continue
                 # If we already raised QueryParametersException above, let it propagate
@@ -465,9 +567,9 @@ class SearchWebjutter(Search):
             raise ConnectionError("Could not get response from Webjutter after multiple attempts.")
 
         try:
-            return response.json()
-        except json.JSONDecodeError:
-            raise JSONDecodeError("Webjutter returned invalid JSON response.")
+            return json_loads(response.content)
+        except ValueError:
+            raise JSONDecodeError("Webjutter returned invalid JSON response.", response.text, 0)
 
     @staticmethod
     def validate_query(query, request, config):
@@ -488,7 +590,7 @@ class SearchWebjutter(Search):
         params = {"q": query.get("query"), "size": 0}
 
         try:
-            response = SearchWebjutter.webjutter_search_request(params, collection, url, user, password, timeout=5, max_retries=1)
+            response = SearchWebjutter.webjutter_search_request(params, collection, url, user, password, timeout=5, max_retries=0)
         except (ConnectionError, Timeout, RequestException, HTTPError, JSONDecodeError) as e:
             raise QueryParametersException(str(e))
 
@@ -5,10 +5,13 @@ Update what Webjutter data sources are available.
 from backend.lib.worker import BasicWorker
 
 import os
+import hashlib
 import requests
 import json
 
 from json import JSONDecodeError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 class WebjutterUpdater(BasicWorker):
     """
@@ -18,6 +21,11 @@ class WebjutterUpdater(BasicWorker):
     type = "webjutter-updater"
     max_workers = 1
 
+    # Kept between runs, so the connection to Webjutter can be reused instead of set up anew every interval
+    session = None
+    # Hash of the datasources last written, so an unchanged overview isn't written again
+    datasources_hash = None
+
     @classmethod
     def ensure_job(cls, config=None):
         """
@@ -27,6 +35,26 @@ class WebjutterUpdater(BasicWorker):
         """
         return {"remote_id": "webjutter-updater", "interval": 120}
 
+    @classmethod
+    def get_session(cls):
+        """
+        Get the session used to reach Webjutter
+
+        Created once per 4CAT process; retries on connection errors are
+        mounted with it.
+
+        :return requests.Session:  Session for Webjutter requests
+        """
+        if cls.session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2,
+                                  max_retries=Retry(total=2, backoff_factor=0.3))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            cls.session = session
+
+        return cls.session
+
     def work(self):
         """
         Update Webjutter settings
@@ -66,8 +94,8 @@ class WebjutterUpdater(BasicWorker):
             # Requests datasources overview from Webjutter API
             response = None
             try:
-                response = requests.get(
-                    webjutter_url + "api/overview", auth=(webjutter_user, webjutter_pw)
+                response = self.get_session().get(
+                    webjutter_url + "api/overview", auth=(webjutter_user, webjutter_pw), timeout=10
                 )
             except requests.RequestException as e:
                 self.log.error("Failed to update Webjutter datasources: " + str(e))
@@ -76,12 +104,20 @@ class WebjutterUpdater(BasicWorker):
             if response and response.status_code == 200:
                 try:
                     collections = response.json()
-                    with webjutter_datasources_file.open("w") as f:
-                        json.dump(collections, f)
+                    payload = json.dumps(collections).encode("utf-8")
+                    payload_hash = hashlib.sha256(payload).digest()
+
+                    # Only write if something changed; the Webjutter datasource re-reads the file when it does.
+                    # Written to a temporary file first, so the datasource never sees a missing or partial file.
+                    if payload_hash != WebjutterUpdater.datasources_hash or not webjutter_datasources_file.exists():
+                        temp_file = webjutter_datasources_file.with_suffix(".json.tmp")
+                        temp_file.write_bytes(payload)
+                        os.replace(temp_file, webjutter_datasources_file)
+                        WebjutterUpdater.datasources_hash = payload_hash
                         self.log.info(
                             f"Updated Webjutter datasources json file at {webjutter_datasources_file}"
                         )
-                        remove_old = False
+                    remove_old = False
                 except JSONDecodeError:
                     self.log.error(
                         "Couldn't parse Webjutter datasource.json:", collections